@@ -5,17 +5,12 @@ from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 from pyicloud import PyiCloudService
-import shutil
 import tempfile
 
 
 def prepare_auth_folder():
-    folder = os.path.join(os.getcwd(), 'auth')
-    try:
-        shutil.rmtree(folder)
-    except FileNotFoundError:
-        pass
-    os.mkdir(folder)
+    folder = os.path.expanduser(os.getenv('AUTH_DIR', os.path.join(os.getcwd(), 'auth')))
+    os.makedirs(folder, exist_ok=True)
     return folder
 
 
@@ -35,8 +30,10 @@ def authenticate_icloud(folder):
         if not api.validate_verification_code(device, code):
             raise Exception('Failed to verify verification code')
 
-    with open(os.path.join(folder, 'icloud.json'), 'w') as file:
-        file.write(f'{{"username":"{username}", "password":"{password}"}}')
+    path = os.path.join(folder, 'icloud.json')
+    with open(path + '.tmp', 'w') as file:
+        json.dump({'username': username, 'password': password}, file)
+    os.replace(path + '.tmp', path)
 
     print('ICloud authentication succeeded')
 
@@ -63,8 +60,7 @@ def authenticate_gcloud(folder):
 
 def main():
     try:
-        #folder = prepare_auth_folder()
-        folder = os.getenv('AUTH_DIR')
+        folder = prepare_auth_folder()
         authenticate_icloud(folder)
         authenticate_gcloud(folder)
         print('Done')
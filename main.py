@@ -1,8 +1,15 @@
 import threading
+import queue
 import signal
+import select
+import socket
 import os
 import sys
 import time
+import contextlib
+import concurrent.futures
+import functools
+import mmap
 import datetime
 from dateutil.parser import parse
 import sqlite3
@@ -21,21 +28,36 @@ ARTIFACTS_TABLE = 'artifacts'
 AUTH_DIR = os.getenv('AUTH_DIR', './auth')
 STORAGE_DIR = os.getenv('STORAGE_DIR', './downloaded')
 DATABASE_FILE = os.getenv('DATABASE_FILE', 'artifacts.sqlite')
+DATABASE_READERS = int(os.getenv('DATABASE_READERS', '4'))
+UPLOAD_THREADS = int(os.getenv('UPLOAD_THREADS', '8'))
+UPLOAD_BATCH_SIZE = 4 * UPLOAD_THREADS
+ALBUM_BATCH_SIZE = 50
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_FLUSH_SIZE = 10
+DOWNLOAD_FLUSH_SECONDS = 30.0
+
+_SQL_INSERT = f'INSERT INTO {ARTIFACTS_TABLE} (id, name, size, created) VALUES (?, ?, ?, ?)'
+_SQL_SELECT_ROWID = f'SELECT ROWID FROM {ARTIFACTS_TABLE} WHERE id=?'
+_SQL_UPDATE_DOWNLOADED = f'UPDATE {ARTIFACTS_TABLE} SET downloaded=1 WHERE id=?'
+_SQL_UPDATE_UPLOADED = f'UPDATE {ARTIFACTS_TABLE} SET uploaded=? WHERE id=?'
+_SQL_UPDATE_ALBUM = f'UPDATE {ARTIFACTS_TABLE} SET album=1 WHERE uploaded=?'
+_SQL_RESET_UPLOADED = f'UPDATE {ARTIFACTS_TABLE} SET uploaded=NULL WHERE uploaded=?'
+_SQL_UPDATE_DELETED = f'UPDATE {ARTIFACTS_TABLE} SET deleted=1 WHERE ROWID=?'
+_SQL_PROGRESS = f'SELECT IFNULL(SUM(deleted=1), 0) AS completed, IFNULL(SUM(downloaded <> 0 AND uploaded IS NOT NULL), 0) AS uploaded, IFNULL(SUM(downloaded <> 0), 0) AS downloaded FROM {ARTIFACTS_TABLE}'
 
 
 def initialize(logger_):
     logger = logger_.bind(database=DATABASE_FILE)
 
-    db = sqlite3.connect(
-        DATABASE_FILE, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+    pool = ConnectionPool()
     logger.info('Connected to database')
 
     logger = logger.bind(table=ARTIFACTS_TABLE)
 
     try:
-        cursor = db.cursor()
-        cursor.execute(
-            f'CREATE TABLE {ARTIFACTS_TABLE} (id TEXT UNIQUE, name TEXT, size INTEGER, created INTEGER, downloaded INTEGER DEFAULT 0, uploaded TEXT DEFAULT NULL, album INTEGER DEFAULT 0, deleted INTEGER DEFAULT 0)')
+        with pool.writer() as db:
+            db.execute(
+                f'CREATE TABLE {ARTIFACTS_TABLE} (id TEXT UNIQUE, name TEXT, size INTEGER, created INTEGER, downloaded INTEGER DEFAULT 0, uploaded TEXT DEFAULT NULL, album INTEGER DEFAULT 0, deleted INTEGER DEFAULT 0)')
     except sqlite3.OperationalError as e:
         if str(e).endswith('already exists'):
             logger.info('Table exists')
@@ -45,25 +67,95 @@ def initialize(logger_):
     else:
         logger.info('Table created')
 
+    with pool.writer() as db:
+        db.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_pending_upload ON {ARTIFACTS_TABLE} (downloaded) WHERE downloaded=1 AND uploaded IS NULL')
+        db.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_pending_album ON {ARTIFACTS_TABLE} (album) WHERE uploaded IS NOT NULL AND album=0')
+        db.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_pending_delete ON {ARTIFACTS_TABLE} (deleted) WHERE album=1 AND deleted=0')
+        db.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_uploaded ON {ARTIFACTS_TABLE} (uploaded)')
+    logger.info('Indexes created')
 
+    with pool.writer() as db:
+        if db.execute('PRAGMA user_version').fetchone()[0] < 1:
+            db.execute(
+                f"UPDATE {ARTIFACTS_TABLE} SET uploaded=CAST(uploaded AS TEXT) WHERE typeof(uploaded)='blob'")
+            db.execute('PRAGMA user_version=1')
+            logger.info('Converted upload tokens to text')
+
+    return pool
+
+
+class RefreshingCredentials (google.oauth2.credentials.Credentials):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._refreshLock = threading.Lock()
+
+    def refresh(self, request):
+        stale = self.token
+        with self._refreshLock:
+            if self.token == stale or not self.valid:
+                super().refresh(request)
+
+
+@functools.lru_cache(maxsize=1)
 def _loadGcloudCredentials():
     filePath = os.path.join(AUTH_DIR, 'gcloud.json')
-    credentials = google.oauth2.credentials.Credentials.from_authorized_user_file(
+    credentials = RefreshingCredentials.from_authorized_user_file(
         filePath)
     return credentials
 
 
-class Connection:
-    def __init__(self):
-        self.connection = None
-
-    def connect(self):
-        self.connection = sqlite3.connect(
-            DATABASE_FILE, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
-        return self.connection
+class ConnectionPool:
+    def __init__(self, readers=DATABASE_READERS):
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._open())
+        self._writer = self._open()
+        self._writeLock = threading.Lock()
+
+    def _open(self):
+        connection = sqlite3.connect(
+            DATABASE_FILE, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None, check_same_thread=False, cached_statements=200)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA busy_timeout=5000')
+        connection.execute('PRAGMA temp_store=MEMORY')
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def acquire(self):
+        return self._readers.get()
+
+    def release(self, connection):
+        self._readers.put(connection)
+
+    @contextlib.contextmanager
+    def reader(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    @contextlib.contextmanager
+    def writer(self):
+        with self._writeLock:
+            self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._writer
+                self._writer.execute('COMMIT')
+            finally:
+                if self._writer.in_transaction:
+                    self._writer.execute('ROLLBACK')
 
-    def disconnect(self):
-        self.connection.close()
+    def close(self):
+        with self._writeLock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
 
 
 class Worker (threading.Thread):
@@ -74,7 +166,7 @@ class Worker (threading.Thread):
         self.exit = False
         self.event = threading.Event()
         self.backoff = Backoff(min_ms=100, max_ms=30000,
-                               factor=2, jitter=False)
+                               factor=2, jitter=True)
         self.lastWorked = time.time()
 
     def run(self):
@@ -117,29 +209,21 @@ class Worker (threading.Thread):
 
 
 class DatabaseWorker (Worker):
-    def __init__(self, name, logger):
+    def __init__(self, name, pool, logger):
         super().__init__(name, logger)
-        self.connection = Connection()
-
-    def setup(self):
-        self.db = self.connection.connect()
-
-    def teardown(self):
-        self.connection.disconnect()
-        self.db = None
+        self.pool = pool
 
 
 class DatabaseQueryWorker (DatabaseWorker):
-    def __init__(self, name, query, logger, batch=False):
-        super().__init__(name, logger)
+    def __init__(self, name, query, pool, logger, batch=False):
+        super().__init__(name, pool, logger)
         self.query = query
         self.batch = batch
 
     def work(self):
-        cursor = self.db.cursor()
         try:
-            cursor.execute(self.query)
-            results = cursor.fetchall()
+            with self.pool.reader() as db:
+                results = db.execute(self.query).fetchall()
             if len(results) > 0:
                 try:
                     if self.batch:
@@ -166,12 +250,17 @@ class DatabaseQueryWorker (DatabaseWorker):
 
 
 class IcloudPhotoDownloader (DatabaseWorker):
-    def __init__(self, logger):
-        super().__init__('ICloud photo library scraper', logger)
+    def __init__(self, pool, logger):
+        super().__init__('ICloud photo library scraper', pool, logger)
         self.backoff = Backoff(min_ms=1000, max_ms=60000,
-                               factor=2, jitter=False)
+                               factor=2, jitter=True)
         self.iterator = None
         self.current = None
+        self.completed = []
+        self.knownIds = set()
+        self.downloadedIds = set()
+        self.rowIds = {}
+        self.lastFlushed = time.time()
         if os.stat(STORAGE_DIR) is None:
             os.mkdir(STORAGE_DIR)
         with open(os.path.join(AUTH_DIR, 'icloud.json'), 'r') as file:
@@ -179,7 +268,21 @@ class IcloudPhotoDownloader (DatabaseWorker):
         self._icloud = PyiCloudService(
             credentials['username'], password=credentials['password'], cookie_directory=AUTH_DIR)
 
+    def setup(self):
+        with self.pool.reader() as db:
+            rows = db.execute(
+                f'SELECT id, downloaded FROM {ARTIFACTS_TABLE}').fetchall()
+        self.knownIds = set(row['id'] for row in rows)
+        self.downloadedIds = set(row['id'] for row in rows if row['downloaded'] != 0)
+        self.logger.info('Loaded known photos', count=len(self.knownIds),
+                         downloaded=len(self.downloadedIds))
+
+    def teardown(self):
+        self._flush()
+
     def work(self):
+        self._flushIfDue()
+
         if self.current is None:
             try:
                 self._next()
@@ -187,6 +290,8 @@ class IcloudPhotoDownloader (DatabaseWorker):
                 self.logger.warn(
                     'Failed to get listing from icloud', reason=e.message)
                 return False
+            if self.current is None:
+                return False
 
         if not self._downloaded(self.current):
             self.logger.warn('Downloading', photo=self.current.id)
@@ -204,76 +309,151 @@ class IcloudPhotoDownloader (DatabaseWorker):
             return False
 
     def _next(self):
-        while self.current is None:
-            if self.iterator is None:
-                self.logger.info('Getting photo iterator')
-                self.iterator = iter(self._icloud.photos.all)
-
-            self.current = next(self.iterator, None)
-            if self.current is None:
-                self.iterator = None
+        if self.iterator is None:
+            self.logger.info('Getting photo iterator')
+            self.iterator = iter(self._icloud.photos.all)
+
+        for photo in self.iterator:
+            if self.exit:
+                return
+            self._flushIfDue()
+            if photo.id not in self.downloadedIds:
+                self.current = photo
+                return
+        self.iterator = None
 
     def _downloaded(self, photo):
-        result = False
-        c = self.db.cursor()
-        c.execute(
-            f'SELECT downloaded FROM {ARTIFACTS_TABLE} WHERE id=?', (photo.id,))
-        r = c.fetchone()
-        if r is not None:
-            result = r[0] != 0
-        else:
-            c.execute(f'INSERT INTO {ARTIFACTS_TABLE} (id, name, size, created) VALUES (?, ?, ?, ?)', (
-                photo.id, photo.filename, photo.size, int(photo.created.timestamp())))
-        c.close()
-        return result
+        if photo.id in self.downloadedIds:
+            return True
+        if photo.id in self.knownIds:
+            return False
+        with self.pool.writer() as db:
+            c = db.execute(_SQL_INSERT, (photo.id, photo.filename, photo.size, int(photo.created.timestamp())))
+        self.knownIds.add(photo.id)
+        self.rowIds[photo.id] = c.lastrowid
+        return False
 
     def _download(self, photo):
-        c = self.db.cursor()
-        c.execute(
-            f'SELECT ROWID FROM {ARTIFACTS_TABLE} WHERE id=?', (photo.id,))
-        r = c.fetchone()
-        if r is not None:
-            with open(f'{STORAGE_DIR}/{r[0]}.dat', 'wb') as f:
-                download = photo.download()
-                for chunk in download.iter_content(chunk_size=4096):
-                    if chunk:
-                        f.write(chunk)
-                f.flush()
-            c.execute(
-                f'UPDATE {ARTIFACTS_TABLE} SET downloaded=1 WHERE id=?', (photo.id,))
+        rowid = self.rowIds.get(photo.id)
+        if rowid is None:
+            with self.pool.reader() as db:
+                r = db.execute(_SQL_SELECT_ROWID, (photo.id,)).fetchone()
+            if r is None:
+                return
+            rowid = r['rowid']
+        with open(f'{STORAGE_DIR}/{rowid}.dat', 'wb') as f:
+            download = photo.download()
+            f.writelines(filter(None, download.iter_content(
+                chunk_size=DOWNLOAD_CHUNK_SIZE)))
+        self.completed.append((photo.id,))
+        self.downloadedIds.add(photo.id)
+        self.rowIds.pop(photo.id, None)
+
+    def _flushIfDue(self):
+        if len(self.completed) >= DOWNLOAD_FLUSH_SIZE or time.time() - self.lastFlushed > DOWNLOAD_FLUSH_SECONDS:
+            self._flush()
+
+    def _flush(self):
+        if len(self.completed) > 0:
+            with self.pool.writer() as db:
+                db.executemany(_SQL_UPDATE_DOWNLOADED, self.completed)
+            self.completed = []
+        self.lastFlushed = time.time()
 
 
 class GoogleUploader (DatabaseQueryWorker):
-    def __init__(self, logger):
+    def __init__(self, albumWorker, pool, logger):
         super().__init__('Google photo uploader',
-                         f'SELECT ROWID, * FROM {ARTIFACTS_TABLE} WHERE downloaded=1 AND uploaded is NULL', logger)
-        self._session = AuthorizedSession(_loadGcloudCredentials())
+                         f'SELECT ROWID, * FROM {ARTIFACTS_TABLE} WHERE downloaded=1 AND uploaded is NULL LIMIT {UPLOAD_BATCH_SIZE}', pool, logger, batch=True)
+        self.albumWorker = albumWorker
+        self._credentials = _loadGcloudCredentials()
+        self._local = threading.local()
+        self._executor = None
+        self._futures = []
 
-    def process(self, result):
-        index = result[0]
-        id = result[1]
-        name = result[2]
+    def setup(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=UPLOAD_THREADS)
+
+    def teardown(self):
+        self._executor.shutdown()
+        self._executor = None
+
+    def stop(self):
+        super().stop()
+        for future in self._futures:
+            future.cancel()
+
+    def process(self, results):
+        self._futures = []
+        for result in results:
+            if self.exit:
+                break
+            self._futures.append(self._executor.submit(self._upload, result))
+
+        uploaded = []
+        throttled = False
+        for result, future in zip(results, self._futures):
+            id = result['id']
+            if future.cancelled() or (self.exit and future.cancel()):
+                continue
+            try:
+                response = future.result()
+            except Exception as e:
+                self.logger.warn('Upload failed', photo=id, exc_info=e)
+                continue
+            if response.status_code // 100 == 2:
+                self.logger.info('Upload complete', photo=id)
+                uploaded.append((response.content.decode('ascii'), id))
+            else:
+                self.logger.warn('Upload failed', photo=id,
+                                 status=response.status_code)
+                if response.status_code == 429 or response.status_code // 100 == 5:
+                    throttled = True
+
+        if len(uploaded) > 0:
+            with self.pool.writer() as db:
+                db.executemany(_SQL_UPDATE_UPLOADED, uploaded)
+            self.albumWorker.event.set()
+
+        if self.exit:
+            return
+        if throttled or len(uploaded) == 0:
+            raise Exception('Upload failed', len(results) - len(uploaded))
+
+    def _upload(self, result):
+        index = result['rowid']
+        id = result['id']
+        name = result['name']
         filename = f'{STORAGE_DIR}/{index}.dat'
         with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
             self.logger.info('Uploading item', photo=id, file=filename)
-            response = self._session.post('https://photoslibrary.googleapis.com/v1/uploads', data=f, headers={
-                'Content-type': 'application/octet-stream',
-                'X-Goog-Upload-File-Name': name,
-                'X-Goog-Upload-Protocol': 'raw'
-            })
-            if response.status_code / 100 == 2:
-                self.logger.info('Upload complete', photo=id, file=filename)
-                c = self.db.cursor()
-                c.execute(
-                    f'UPDATE {ARTIFACTS_TABLE} SET uploaded=? WHERE id=?', (response.content, id))
-            else:
-                raise Exception('Upload failed', response.status_code)
+            if size == 0:
+                return self._post(name, b'')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as data:
+                return self._post(name, data)
+
+    def _post(self, name, data):
+        return self._session().post('https://photoslibrary.googleapis.com/v1/uploads', data=data, headers={
+            'Content-type': 'application/octet-stream',
+            'Content-Length': str(len(data)),
+            'X-Goog-Upload-File-Name': name,
+            'X-Goog-Upload-Protocol': 'raw'
+        })
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = AuthorizedSession(
+                self._credentials)
+        return session
 
 
 class GoogleAlbumAppender (DatabaseQueryWorker):
-    def __init__(self, album, logger):
+    def __init__(self, album, pool, logger):
         super().__init__('Google photo album appender',
-                         f'SELECT * FROM {ARTIFACTS_TABLE} WHERE uploaded is not NULL AND album=0', logger, batch=True)
+                         f'SELECT * FROM {ARTIFACTS_TABLE} WHERE uploaded is not NULL AND album=0', pool, logger, batch=True)
         self.title = album
         self.album = None
         self.logger = self.logger.bind(album=self.title)
@@ -283,29 +463,35 @@ class GoogleAlbumAppender (DatabaseQueryWorker):
     def process(self, results):
         self._setAlbumId()
 
+        for start in range(0, len(results), ALBUM_BATCH_SIZE):
+            self._append(results[start:start + ALBUM_BATCH_SIZE])
+
+    def _append(self, results):
         data = {
             'albumId': self.album['id'],
             'newMediaItems': list(map(lambda row: {
-                'description': row[1],
+                'description': row['name'],
                 'simpleMediaItem': {
-                    'uploadToken': row[5].decode("ascii")
+                    'uploadToken': row['uploaded']
                 }
             }, results))
         }
 
         response = self._gphotos.mediaItems().batchCreate(body=data).execute()
 
-        count = 0
-        c = self.db.cursor()
+        added = []
+        failed = []
         for item in response['newMediaItemResults']:
             if item['status']['message'] == 'OK' or item['status']['message'] == 'Success':
-                c.execute(f'UPDATE {ARTIFACTS_TABLE} SET album=1 WHERE uploaded=?',
-                          (item['uploadToken'].encode('ascii'),))
-                count += 1
+                added.append((item['uploadToken'],))
             else:
                 self.logger.warn('Failed to append item to album, retrying', file=item['mediaItem']['description'])
-                c.execute(f'UPDATE {ARTIFACTS_TABLE} SET uploaded=NULL WHERE uploaded=?',
-                          (item['uploadToken'].encode('ascii'),))
+                failed.append((item['uploadToken'],))
+
+        with self.pool.writer() as db:
+            db.executemany(_SQL_UPDATE_ALBUM, added)
+            db.executemany(_SQL_RESET_UPLOADED, failed)
+        count = len(added)
         if count > 0:
             self.logger.info(f'Added {count} items to album')
 
@@ -324,41 +510,30 @@ class GoogleAlbumAppender (DatabaseQueryWorker):
 
 
 class Cleaner (DatabaseQueryWorker):
-    def __init__(self, logger):
+    def __init__(self, pool, logger):
         super().__init__('Cleaner',
-                         f'SELECT ROWID FROM {ARTIFACTS_TABLE} WHERE album=1 AND deleted=0', logger)
+                         f'SELECT ROWID FROM {ARTIFACTS_TABLE} WHERE album=1 AND deleted=0', pool, logger)
 
     def process(self, result):
-        id = result[0]
+        id = result['rowid']
         filename = f'{STORAGE_DIR}/{id}.dat'
         os.remove(filename)
         self.logger.info('Removed download artifact', file=filename)
-        c = self.db.cursor()
-        c.execute(
-            f'UPDATE {ARTIFACTS_TABLE} SET deleted=1 WHERE ROWID=?', (id,))
+        with self.pool.writer() as db:
+            db.execute(_SQL_UPDATE_DELETED, (id,))
 
 
 class ProgressLogger:
-    def __init__(self, logger):
+    def __init__(self, pool, logger):
         self.logger = logger.bind(worker='Progress logger')
-        self.connection = Connection()
-
-    def start(self):
-        self.db = self.connection.connect()
-        self.cursor = self.db.cursor()
-
-    def stop(self):
-        self.connection.disconnect()
-        self.cursor = None
-        self.db = None
+        self.pool = pool
 
     def emit(self):
-        self.cursor.execute(
-            f'SELECT (SELECT count(ROWID) FROM {ARTIFACTS_TABLE} WHERE deleted=1) AS completed, (SELECT count(ROWID) FROM {ARTIFACTS_TABLE} WHERE downloaded <> 0 AND uploaded IS NOT NULL) AS uploaded, (SELECT count(ROWID) FROM {ARTIFACTS_TABLE} WHERE downloaded <> 0) AS downloaded')
-        results = self.cursor.fetchall()[0]
-        completed = results[0]
-        uploaded = results[1]
-        downloaded = results[2]
+        with self.pool.reader() as db:
+            results = db.execute(_SQL_PROGRESS).fetchone()
+        completed = results['completed']
+        uploaded = results['uploaded']
+        downloaded = results['downloaded']
         self.logger.info('Progress', downloaded=downloaded,
                          uploaded=uploaded, completed=completed)
         return True
@@ -376,32 +551,39 @@ def main():
         run = False
         print()
 
+    wakeup, notify = socket.socketpair()
+    notify.setblocking(False)
+    signal.set_wakeup_fd(notify.fileno())
     signal.signal(signal.SIGINT, stop)
     signal.signal(signal.SIGTERM, stop)
 
-    initialize(logger)
+    pool = initialize(logger)
 
-    workers.append(IcloudPhotoDownloader(logger))
-    workers.append(GoogleUploader(logger))
-    workers.append(GoogleAlbumAppender('From ICloud', logger))
-    workers.append(Cleaner(logger))
+    albumAppender = GoogleAlbumAppender('From ICloud', pool, logger)
+    workers.append(IcloudPhotoDownloader(pool, logger))
+    workers.append(GoogleUploader(albumAppender, pool, logger))
+    workers.append(albumAppender)
+    workers.append(Cleaner(pool, logger))
 
     for worker in workers:
         worker.start()
 
-    progressLogger = ProgressLogger(logger)
-    progressLogger.start()
+    progressLogger = ProgressLogger(pool, logger)
 
     while run:
-        minIdle = min(list(map(lambda w: w.idle(), workers)))
+        signalled, _, _ = select.select([wakeup], [], [], 10.0)
+        if signalled or not run:
+            break
+        progressLogger.emit()
+        minIdle = min(w.idle() for w in workers)
         if (minIdle > MAX_IDLE_SECONDS):
             logger.info(
                 f'All workers have been idle for more than {MAX_IDLE_SECONDS} seconds, we are done.')
             break
-        time.sleep(10.0)
-        progressLogger.emit()
 
-    progressLogger.stop()
+    signal.set_wakeup_fd(-1)
+    wakeup.close()
+    notify.close()
 
     for worker in workers:
         worker.stop()
@@ -409,6 +591,8 @@ def main():
     for worker in workers:
         worker.join()
 
+    pool.close()
+
 
 if __name__ == "__main__":
     main()